@@ -0,0 +1,74 @@
+import asyncio
+import gzip
+import zlib
+from typing import List, Union
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Low levels compress JSON nearly as well as the maximum, in a fraction of the time
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def supported_encodings() -> List[str]:
+    """Content codings this server can produce, in order of preference"""
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+
+def choose_encoding(accept_encoding: str) -> Union[str, None]:
+    """Picks the encoding to use for a response from a request's Accept-Encoding header, or None to send it as is"""
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        parts = item.strip().split(";")
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        accepted[parts[0].strip()] = quality
+    best = None
+    best_quality = 0.0
+    for encoding in supported_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0))
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor():
+    """
+    Compresses a streamed response a chunk at a time on a worker thread.  Each chunk is flushed, so the client can
+    decode everything written so far.  Chunks must be compressed one at a time, in order.
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def _compress(self, data: bytes, last: bool) -> bytes:
+        if self.encoding == "br":
+            out = self._compressor.process(data)
+            return out + (self._compressor.finish() if last else self._compressor.flush())
+        out = self._compressor.compress(data)
+        return out + self._compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    async def compress(self, data: bytes, last: bool = False) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(None, self._compress, data, last)
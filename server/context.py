@@ -0,0 +1,125 @@
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple, Union
+from .expiring import ExpiringDict
+
+# Token counts and summaries are cached across requests, since clients resend the whole history every turn
+TOKEN_CACHE_TTL_SECONDS = 60 * 60
+TOKEN_CACHE_SIZE = 50000
+SUMMARY_CACHE_TTL_SECONDS = 24 * 60 * 60
+SUMMARY_CACHE_SIZE = 1000
+
+# Tokens taken up by the brackets around the message list
+LIST_OVERHEAD_TOKENS = 2
+
+
+@dataclass
+class ContextPlan:
+    """The messages to send upstream for one completion, after fitting the history into the prompt budget"""
+    system: Dict[str, Any]
+    kept: List[Dict[str, Any]]
+    dropped: List[Dict[str, Any]]
+    prompt_tokens: int
+    summary: Union[str, None] = None
+    summary_tokens: int = 0
+    # Messages in 'dropped' that a cached summary already covers, and that summary
+    covered: int = 0
+    covered_summary: Union[str, None] = None
+    prefix_keys: List[str] = field(default_factory=list)
+
+    @property
+    def trimmed(self) -> int:
+        return len(self.dropped)
+
+    def messages(self) -> List[Dict[str, Any]]:
+        messages = [self.system]
+        if self.summary is not None:
+            messages.append(summary_message(self.summary))
+        return messages + self.kept
+
+
+def summary_message(summary: str) -> Dict[str, Any]:
+    return {"role": "system", "content": "Summary of the earlier conversation: " + summary}
+
+
+class ContextPlanner():
+    """
+    Picks the newest messages of a chat that fit in a prompt token budget, always keeping the system prompt.  History
+    that doesn't fit can be replaced by a summary, which is cached by the exact messages it covers.  Messages are
+    dropped in blocks so the dropped prefix, and so its summary, stays the same for several turns in a row.
+    """
+
+    def __init__(self):
+        self._token_counts: ExpiringDict[Tuple[int, bytes], int] = ExpiringDict(
+            TOKEN_CACHE_TTL_SECONDS, TOKEN_CACHE_SIZE, sliding=True)
+        self._summaries: ExpiringDict[str, str] = ExpiringDict(
+            SUMMARY_CACHE_TTL_SECONDS, SUMMARY_CACHE_SIZE, sliding=True)
+
+    def count(self, model, message: Dict[str, Any]) -> int:
+        """Tokens a single message takes up in the serialized prompt, including the separator after it"""
+        text = json.dumps(message, separators=(',', ':'))
+        key = (id(model.encoding), hashlib.blake2b(text.encode(), digest_size=16).digest())
+        count = self._token_counts.get(key)
+        if count is None:
+            count = model.tokenCount(text) + 1
+            self._token_counts[key] = count
+        return count
+
+    def plan(self, model, system: Dict[str, Any], history: List[Dict[str, Any]], budget: int,
+             summary_reserve: int = 0, block: int = 1) -> ContextPlan:
+        system_tokens = self.count(model, system) + LIST_OVERHEAD_TOKENS
+        available = budget - system_tokens
+        counts = [self.count(model, m) for m in history]
+        if sum(counts) > available:
+            # Leave room for a summary of whatever gets dropped
+            available -= summary_reserve
+        keep = 0
+        used = 0
+        for count in reversed(counts):
+            # The newest message is always sent, even if it doesn't fit on its own
+            if used + count > available and keep > 0:
+                break
+            used += count
+            keep += 1
+        drop = len(history) - keep
+        if drop > 0 and block > 1:
+            drop = min(len(history) - 1, ((drop + block - 1) // block) * block)
+        return ContextPlan(system, history[drop:], history[:drop], system_tokens + sum(counts[drop:]))
+
+    def find_summary(self, plan: ContextPlan, block: int):
+        """
+        Looks up a cached summary for the plan's dropped messages.  If there isn't one, finds the longest block-aligned
+        prefix of them that does have one, so only the messages after it need summarizing.
+        """
+        keys = []
+        digest = hashlib.sha1()
+        for i, message in enumerate(plan.dropped):
+            digest.update(json.dumps(message, separators=(',', ':')).encode())
+            digest.update(b"\0")
+            if (i + 1) % block == 0 or i + 1 == len(plan.dropped):
+                keys.append((i + 1, digest.hexdigest()))
+        plan.prefix_keys = [key for _, key in keys]
+        for covered, key in reversed(keys):
+            summary = self._summaries.get(key)
+            if summary is not None:
+                plan.covered = covered
+                plan.covered_summary = summary
+                return
+
+    def store_summary(self, plan: ContextPlan, summary: str):
+        """Caches a summary of all of the plan's dropped messages"""
+        if len(plan.prefix_keys) > 0:
+            self._summaries[plan.prefix_keys[-1]] = summary
+
+    def use_summary(self, model, plan: ContextPlan, summary: str):
+        """Sends the summary in place of the plan's dropped messages"""
+        plan.summary = summary
+        plan.summary_tokens = self.count(model, summary_message(summary))
+        plan.prompt_tokens += plan.summary_tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "token_counts": self._token_counts.stats(),
+            "summaries": self._summaries.stats()
+        }
@@ -2,9 +2,12 @@ from dataclasses import fields, Field
 import aiosqlite
 from datetime import datetime
 import uuid
-from typing import List, Union, Type, TypeVar, Callable, Any
+from typing import List, Union, Type, TypeVar, Callable, Any, AsyncIterator, Optional, Tuple, Dict
+from .profiling import profiled
 
 T = TypeVar('T')
+# Raw statements to run in another write's transaction, as (query, rows of values for its ? placeholders)
+Statements = List[Tuple[str, List[List[Any]]]]
 
 
 def _convertDateTime(v):
@@ -12,6 +15,11 @@ def _convertDateTime(v):
         return None
     try:
         return datetime.strptime(v, "%Y-%m-%d %H:%M:%S.%f%z")
+    except:
+        pass
+    try:
+        # str() of a datetime leaves out the fraction when microseconds are 0
+        return datetime.fromisoformat(v)
     except:
         return None
 
@@ -50,6 +58,7 @@ class SQLiteDB:
                         async with conn.execute(query) as c:
                             pass
 
+    @profiled("db")
     async def get_all(self, dataclass: Type[T]) -> List[T]:
         converters = {f.name: self._converter(f) for f in fields(dataclass)}
         async with aiosqlite.connect(self.dbfile) as conn:
@@ -67,6 +76,7 @@ class SQLiteDB:
                     objects.append(obj)
                 return objects
 
+    @profiled("db")
     async def find_by_id(self, dataclass: Type[T], id) -> Union[T, None]:
         converters = {f.name: self._converter(f) for f in fields(dataclass)}
         async with aiosqlite.connect(self.dbfile) as conn:
@@ -81,6 +91,7 @@ class SQLiteDB:
                     return obj
                 return None
 
+    @profiled("db")
     async def find(self, dataclass: Type[T], find_fields: Union[str, List[str]] = "*", **kwargs) -> List[T]:
         converters = {f.name: self._converter(f) for f in fields(dataclass)}
         async with aiosqlite.connect(self.dbfile) as conn:
@@ -100,6 +111,200 @@ class SQLiteDB:
                     results.append(obj)
             return results
 
+    async def iterate(self, dataclass: Type[T], find_fields: Union[str, List[str]] = "*", **kwargs) -> AsyncIterator[T]:
+        """Like find(), but yields objects as rows are read from the cursor rather than loading them all into memory"""
+        converters = {f.name: self._converter(f) for f in fields(dataclass)}
+        async with aiosqlite.connect(self.dbfile) as conn:
+            where = " AND ".join(["{}=?".format(k) for k, _ in kwargs.items()])
+            values = [v for _, v in kwargs.items()]
+            if isinstance(find_fields, list):
+                find_fields = ",".join(find_fields)
+            async with conn.execute("SELECT {} from {} WHERE {}".format(find_fields, dataclass.__name__.lower(), where), values) as c:
+                attrs = [r[0] for r in c.description]
+                async for result in c:
+                    mapped_values = {}
+                    for i, attr in enumerate(attrs):
+                        mapped_values[attr] = converters[attr](result[i])
+                    yield dataclass(**mapped_values)
+
+    @profiled("db")
+    async def find_after(self, dataclass: Type[T], field: str, after: datetime, find_fields: Union[str, List[str]] = "*", **kwargs) -> List[T]:
+        """Like find(), but only returns rows where the datetime column 'field' is later than 'after'"""
+        converters = {f.name: self._converter(f) for f in fields(dataclass)}
+        async with aiosqlite.connect(self.dbfile) as conn:
+            where = " AND ".join(["{}=?".format(k) for k, _ in kwargs.items()] + ["{}>?".format(field)])
+            values = [v for _, v in kwargs.items()] + [str(after)]
+            results = []
+            if isinstance(find_fields, list):
+                find_fields = ",".join(find_fields)
+            async with conn.execute("SELECT {} from {} WHERE {}".format(find_fields, dataclass.__name__.lower(), where), values) as c:
+                for result in await c.fetchall():
+                    attrs = [r[0] for r in c.description]
+                    mapped_values = {}
+                    for i, attr in enumerate(attrs):
+                        mapped_values[attr] = converters[attr](result[i])
+                    results.append(dataclass(**mapped_values))
+            return results
+
+    @profiled("db")
+    async def select(self, dataclass: Type[T], where: str, values: List[Any], find_fields: Union[str, List[str]] = "*") -> List[T]:
+        """Returns the rows matching an arbitrary WHERE clause (which may also order or limit them), using ? placeholders for 'values'"""
+        converters = {f.name: self._converter(f) for f in fields(dataclass)}
+        if isinstance(find_fields, list):
+            find_fields = ",".join(find_fields)
+        results = []
+        async with aiosqlite.connect(self.dbfile) as conn:
+            async with conn.execute("SELECT {} from {} WHERE {}".format(find_fields, dataclass.__name__.lower(), where), values) as c:
+                attrs = [r[0] for r in c.description]
+                for result in await c.fetchall():
+                    mapped_values = {}
+                    for i, attr in enumerate(attrs):
+                        mapped_values[attr] = converters[attr](result[i])
+                    results.append(dataclass(**mapped_values))
+        return results
+
+    @profiled("db")
+    async def count(self, dataclass: Type[T], where: str, values: List[Any]) -> int:
+        """Returns the number of rows matching a WHERE clause, using ? placeholders for 'values'"""
+        async with aiosqlite.connect(self.dbfile) as conn:
+            async with conn.execute("SELECT COUNT(*) from {} WHERE {}".format(dataclass.__name__.lower(), where), values) as c:
+                return (await c.fetchone())[0]
+
+    @profiled("db")
+    async def execute(self, query: str, values: List[Any]) -> int:
+        """Runs a single statement in its own transaction and returns the number of rows it changed"""
+        async with aiosqlite.connect(self.dbfile) as conn:
+            async with conn.execute(query, values) as c:
+                await conn.commit()
+                return c.rowcount
+
+    @profiled("db")
+    async def update_fields(self, dataclass: Type[T], id, **kwargs):
+        """Updates only the given columns of a single row, leaving the rest as they are"""
+        attrs = ", ".join(["{}=?".format(k) for k in kwargs.keys()])
+        values = [str(v) for v in kwargs.values()] + [id]
+        async with aiosqlite.connect(self.dbfile) as conn:
+            async with conn.execute('UPDATE {} SET {} WHERE {}=?'.format(
+                    dataclass.__name__.lower(), attrs, self._get_pk_field(dataclass)), values) as c:
+                await conn.commit()
+
+    @profiled("db")
+    async def find_in(self, dataclass: Type[T], field: str, values: List[Any], find_fields: Union[str, List[str]] = "*") -> List[T]:
+        """Returns every row where 'field' is one of 'values'"""
+        converters = {f.name: self._converter(f) for f in fields(dataclass)}
+        if isinstance(find_fields, list):
+            find_fields = ",".join(find_fields)
+        results = []
+        async with aiosqlite.connect(self.dbfile) as conn:
+            # stay well under SQLite's limit on the number of query parameters
+            for start in range(0, len(values), 500):
+                chunk = values[start:start + 500]
+                query = "SELECT {} from {} WHERE {} IN ({})".format(
+                    find_fields, dataclass.__name__.lower(), field, ",".join("?" for _ in chunk))
+                async with conn.execute(query, chunk) as c:
+                    attrs = [r[0] for r in c.description]
+                    for result in await c.fetchall():
+                        mapped_values = {}
+                        for i, attr in enumerate(attrs):
+                            mapped_values[attr] = converters[attr](result[i])
+                        results.append(dataclass(**mapped_values))
+        return results
+
+    @profiled("db")
+    async def upsert_many(self, objects: List[Any], owner_field: Optional[str] = None, statements: Optional[Statements] = None) -> int:
+        """
+        Inserts or updates many rows of the same type in a single transaction and returns the number of rows changed.
+        If owner_field is given, an existing row is only overwritten when its owner_field matches the new value.  Each
+        (query, rows) in 'statements' is run for all of its rows afterward, in the same transaction.
+        """
+        if len(objects) == 0:
+            return 0
+        async with aiosqlite.connect(self.dbfile) as conn:
+            try:
+                before = conn.total_changes
+                await conn.executemany(self._upsert_query(objects[0], owner_field), [list(self._get_key_values(o).values()) for o in objects])
+                changed = conn.total_changes - before
+                for query, rows in statements or []:
+                    await conn.executemany(query, rows)
+                await conn.commit()
+            except:
+                await conn.rollback()
+                raise
+            return changed
+
+    @profiled("db")
+    async def write_batch(self, upserts: List[Any], deletes: List[Any], statements: Optional[Statements] = None):
+        """
+        Inserts or updates every object in 'upserts', deletes every object in 'deletes', and runs each (query, rows) in
+        'statements' for all of its rows, in a single transaction
+        """
+        async with aiosqlite.connect(self.dbfile) as conn:
+            try:
+                for group in self._group_by_type(upserts):
+                    await conn.executemany(self._upsert_query(group[0]), [list(self._get_key_values(o).values()) for o in group])
+                for group in self._group_by_type(deletes):
+                    pk_field = self._get_pk_field(group[0])
+                    await conn.executemany('DELETE FROM {} WHERE {}=?'.format(type(group[0]).__name__.lower(), pk_field),
+                                           [[str(getattr(o, pk_field))] for o in group])
+                for query, rows in statements or []:
+                    await conn.executemany(query, rows)
+                await conn.commit()
+            except:
+                await conn.rollback()
+                raise
+
+    @profiled("db")
+    async def append_and_increment(self, inserts: List[Any], increments: List[Any],
+                                   additions: Optional[List[Tuple[Any, Dict[str, float], Dict[str, Any], Dict[str, Any]]]] = None):
+        """
+        Inserts every object in 'inserts', and adds each object in 'increments' to the row with the same primary key
+        (creating it if needed) by summing their int and float columns, all in a single transaction.  Each
+        (dataclass, amounts, values, where) in 'additions' adds the amounts to those fields and sets the values of
+        existing rows matching 'where'.
+        """
+        async with aiosqlite.connect(self.dbfile) as conn:
+            try:
+                for group in self._group_by_type(inserts):
+                    columns = [f.name for f in fields(group[0])]
+                    await conn.executemany('INSERT INTO {} ({}) values ({})'.format(
+                        type(group[0]).__name__.lower(), ", ".join(columns), ",".join("?" for _ in columns)),
+                        [list(self._get_key_values(o).values()) for o in group])
+                for group in self._group_by_type(increments):
+                    table = type(group[0]).__name__.lower()
+                    columns = [f.name for f in fields(group[0])]
+                    updates = ", ".join(["{0}={1}.{0}+excluded.{0}".format(f.name, table)
+                                        for f in fields(group[0]) if f.type in (int, float)])
+                    await conn.executemany('INSERT INTO {} ({}) values ({}) ON CONFLICT({}) DO UPDATE SET {}'.format(
+                        table, ", ".join(columns), ",".join("?" for _ in columns), self._get_pk_field(group[0]), updates),
+                        [list(self._get_key_values(o).values()) for o in group])
+                for dataclass, amounts, values, where in additions or []:
+                    updates = ["{0}={0}+?".format(k) for k in amounts] + ["{}=?".format(k) for k in values]
+                    await conn.execute('UPDATE {} SET {} WHERE {}'.format(
+                        dataclass.__name__.lower(), ", ".join(updates), " AND ".join(["{}=?".format(k) for k in where])),
+                        list(amounts.values()) + [str(v) for v in values.values()] + [str(v) for v in where.values()])
+                await conn.commit()
+            except:
+                await conn.rollback()
+                raise
+
+    def _group_by_type(self, objects: List[Any]) -> List[List[Any]]:
+        groups = {}
+        for o in objects:
+            groups.setdefault(type(o), []).append(o)
+        return list(groups.values())
+
+    def _upsert_query(self, dataclass, owner_field: Optional[str] = None) -> str:
+        table = type(dataclass).__name__.lower()
+        pk = self._get_pk_field(dataclass)
+        columns = [f.name for f in fields(dataclass)]
+        updates = ", ".join([f"{k}=excluded.{k}" for k in columns if k != pk])
+        query = 'INSERT INTO {} ({}) values ({}) ON CONFLICT({}) DO UPDATE SET {}'.format(
+            table, ", ".join(columns), ",".join("?" for _ in columns), pk, updates)
+        if owner_field is not None:
+            query += " WHERE {0}.{1}=excluded.{1}".format(table, owner_field)
+        return query
+
+    @profiled("db")
     async def insert(self, dataclass):
         async with aiosqlite.connect(self.dbfile) as conn:
             key_values = self._get_key_values(dataclass)
@@ -111,6 +316,7 @@ class SQLiteDB:
                 await conn.commit()
                 return dataclass
 
+    @profiled("db")
     async def update(self, dataclass):
         async with aiosqlite.connect(self.dbfile) as conn:
             key_values = self._get_key_values(dataclass)
@@ -122,6 +328,7 @@ class SQLiteDB:
                 await conn.commit()
                 return dataclass
 
+    @profiled("db")
     async def delete(self, dataclass):
         async with aiosqlite.connect(self.dbfile) as conn:
             key_values = self._get_key_values(dataclass)
@@ -26,7 +26,7 @@ class UserBasic:
         self.api_key = user.api_key
 
 
-@dataclass
+@dataclass(slots=True)
 class Session:
     user_id: str
     session_id: str
@@ -52,8 +52,61 @@ class Chat:
                 "temporary_name", "automatic_name"]
 
 
+@dataclass
+class DeletedChat:
+    """A tombstone left behind when a chat is deleted, so other devices can learn about the deletion"""
+    id: str
+    user_id: str
+    deleted: datetime
+    IS_PRIMARY_KEY = 'id'
+
+
 @dataclass
 class Global:
     id: str
     total_spending: float
     IS_PRIMARY_KEY = 'id'
+
+
+@dataclass
+class Usage:
+    """One entry in the append-only usage ledger, written when a completion ends"""
+    id: str
+    user_id: str
+    chat_id: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    cost_usd: float
+    created: datetime
+    IS_PRIMARY_KEY = 'id'
+
+
+@dataclass
+class UsageRollup:
+    """Running totals of the usage ledger for one user, broken down by 'kind' ("total", "chat", "model" or "day")"""
+    id: str
+    user_id: str
+    kind: str
+    key: str
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost_usd: float = 0
+    IS_PRIMARY_KEY = 'id'
+
+
+@dataclass
+class Job:
+    """Background work waiting to run, kept in the database so it survives restarts"""
+    id: str
+    kind: str
+    key: str
+    status: str = "pending"
+    attempts: int = 0
+    # Bumped every time the job is queued again, so a run knows whether it's still the latest
+    generation: int = 0
+    run_after: datetime = datetime.min
+    created: datetime = datetime.min
+    last_error: str = ""
+    IS_PRIMARY_KEY = 'id'
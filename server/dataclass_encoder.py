@@ -1,5 +1,5 @@
 import json
-from dataclasses import asdict, is_dataclass
+from dataclasses import asdict, is_dataclass, fields
 from typing import Any
 
 
@@ -11,8 +11,9 @@ class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj: Any) -> Any:
         if is_dataclass(obj):
             data_dict = {}
-            for field_name, field_value in obj.__dict__.items():
-                data_dict[field_name] = self.default(field_value)
+            # fields() rather than __dict__, so dataclasses using __slots__ work too
+            for field in fields(obj):
+                data_dict[field.name] = self.default(getattr(obj, field.name))
             return data_dict
         elif isinstance(obj, (list, tuple)):
             return [self.default(item) for item in obj]
@@ -0,0 +1,119 @@
+import heapq
+import itertools
+import sys
+import time
+from typing import Dict, Generic, Iterator, List, Tuple, TypeVar, Union, Any
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+
+class ExpiringDict(Generic[K, V]):
+    """
+    A dict-like map whose entries expire 'ttl' seconds after they're added (or last read, if 'sliding' is set), and which
+    never holds more than 'max_size' entries.  Expiry deadlines are kept in a heap, and expired entries are dropped on
+    every access rather than by a periodic sweep.  When full, the entry closest to expiring is evicted to make room.
+    """
+
+    def __init__(self, ttl: float, max_size: int, sliding: bool = False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sliding = sliding
+        self._entries: Dict[K, Tuple[float, V]] = {}
+        # (deadline, insertion order, key).  Entries get re-pushed when their deadline moves, so stale
+        # heap items are skipped unless their deadline matches the one in _entries.
+        self._heap: List[Tuple[float, int, K]] = []
+        self._counter = itertools.count()
+
+    def _expire(self, now: float):
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == deadline:
+                del self._entries[key]
+
+    def _push(self, key: K, value: V, now: float):
+        deadline = now + self.ttl
+        self._entries[key] = (deadline, value)
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Too many stale items from refreshed or removed entries, so rebuild the heap from what's live
+            self._heap = [(deadline, next(self._counter), key) for key, (deadline, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def _evict_one(self):
+        while len(self._heap) > 0:
+            deadline, _, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == deadline:
+                del self._entries[key]
+                return
+
+    def __setitem__(self, key: K, value: V):
+        now = time.monotonic()
+        self._expire(now)
+        if key not in self._entries and len(self._entries) >= self.max_size:
+            self._evict_one()
+        self._push(key, value, now)
+
+    def get(self, key: K, default: Union[V, None] = None) -> Union[V, None]:
+        now = time.monotonic()
+        self._expire(now)
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if self.sliding:
+            self._push(key, entry[1], now)
+        return entry[1]
+
+    def pop(self, key: K, *default: Any) -> V:
+        self._expire(time.monotonic())
+        if key in self._entries:
+            return self._entries.pop(key)[1]
+        if len(default) > 0:
+            return default[0]
+        raise KeyError(key)
+
+    def __contains__(self, key: K) -> bool:
+        self._expire(time.monotonic())
+        return key in self._entries
+
+    def __len__(self) -> int:
+        self._expire(time.monotonic())
+        return len(self._entries)
+
+    def values(self) -> List[V]:
+        self._expire(time.monotonic())
+        return [value for _, value in self._entries.values()]
+
+    def __iter__(self) -> Iterator[K]:
+        self._expire(time.monotonic())
+        return iter(list(self._entries.keys()))
+
+    def stats(self) -> Dict[str, Any]:
+        """Reports the size of the map and approximately how many bytes each entry uses, including its share of the heap"""
+        count = len(self)
+        if count == 0:
+            return {"entries": 0, "max_size": self.max_size, "bytes_per_entry": 0, "total_bytes": 0}
+        # Sample a few entries rather than measuring all of them
+        sample = list(itertools.islice(self._entries.items(), 100))
+        entry_bytes = sum([_deep_size(key) + sys.getsizeof(entry) + _deep_size(entry[1]) for key, entry in sample]) / len(sample)
+        heap_item_bytes = sys.getsizeof(self._heap[0]) if len(self._heap) > 0 else 0
+        overhead = sys.getsizeof(self._entries) + sys.getsizeof(self._heap) + len(self._heap) * heap_item_bytes
+        per_entry = entry_bytes + overhead / count
+        return {
+            "entries": count,
+            "max_size": self.max_size,
+            "bytes_per_entry": round(per_entry),
+            "total_bytes": round(per_entry * count)
+        }
+
+
+def _deep_size(obj: Any) -> int:
+    """Approximate size of an object and the attributes it holds, one level deep"""
+    size = sys.getsizeof(obj)
+    for name in getattr(type(obj), "__slots__", []):
+        size += sys.getsizeof(getattr(obj, name, None))
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__) + sum([sys.getsizeof(v) for v in obj.__dict__.values()])
+    return size
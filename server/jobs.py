@@ -0,0 +1,158 @@
+import asyncio
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Tuple, Any
+from .database import SQLiteDB
+from .database_classes import Job
+
+Handler = Callable[[str], Awaitable[None]]
+
+# How often the queue is checked when nothing wakes it up sooner
+POLL_SECONDS = 30
+
+
+class JobQueue():
+    """
+    Runs background work (like naming chats) off the request path.  Jobs are stored in the database and identified
+    by their kind and key (eg a chat id), so queueing the same work again before it runs coalesces into a single run.
+    At most 'workers' jobs run at once, and failed jobs are retried with exponential backoff.
+    """
+
+    def __init__(self, db: SQLiteDB, workers: int = 2, max_attempts: int = 5, retry_delay: float = 30):
+        self.db = db
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._handlers: Dict[str, Handler] = {}
+        self._ready: asyncio.Queue = asyncio.Queue(workers)
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._retried = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._run_total = 0.0
+        self._run_max = 0.0
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    async def start(self):
+        # Anything left running when the server last stopped gets another go
+        await self.db.execute("UPDATE job SET status='pending' WHERE status='running'", [])
+        self._tasks.append(asyncio.create_task(self._dispatch()))
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def enqueue(self, kind: str, key: str, delay: float = 0):
+        """
+        Queues a job to run after 'delay' seconds.  If the same job is already waiting, it keeps its original time, so
+        queueing it many times in a row still only runs it once.  If it's running, it runs again afterward.
+        """
+        query, rows = self.enqueue_statement(kind, [key], delay)
+        await self.db.execute(query, rows[0])
+        if delay <= 0:
+            self._wake.set()
+
+    def enqueue_statement(self, kind: str, keys: List[str], delay: float) -> Tuple[str, List[List[Any]]]:
+        """
+        The statement and rows that queue a job for each key like enqueue() does, for running in the same transaction
+        as another write.  Like delayed jobs, they don't wake the queue, so they start within POLL_SECONDS of being due.
+        """
+        now = datetime.now(timezone.utc)
+        run_after = now + timedelta(seconds=delay)
+        return ("INSERT INTO job (id, kind, key, status, attempts, generation, run_after, created, last_error) "
+                "VALUES (?, ?, ?, 'pending', 0, 0, ?, ?, '') ON CONFLICT(id) DO UPDATE SET generation=job.generation+1, "
+                "attempts=0, run_after=CASE WHEN job.status='running' THEN excluded.run_after ELSE job.run_after END",
+                [["{}/{}".format(kind, key), kind, key, str(run_after), str(now)] for key in keys])
+
+    async def _dispatch(self):
+        while True:
+            try:
+                self._wake.clear()
+                now = datetime.now(timezone.utc)
+                due = await self.db.select(Job, "status='pending' AND run_after<=? ORDER BY run_after LIMIT ?",
+                                           [str(now), self.workers])
+                for job in due:
+                    claimed = await self.db.execute("UPDATE job SET status='running' WHERE id=? AND status='pending'", [job.id])
+                    if claimed:
+                        # Blocks while every worker is busy
+                        await self._ready.put(job)
+                if len(due) > 0:
+                    continue
+                wait = POLL_SECONDS
+                upcoming = await self.db.select(Job, "status='pending' ORDER BY run_after LIMIT 1", [])
+                if len(upcoming) > 0 and upcoming[0].run_after is not None:
+                    wait = min(wait, max((upcoming[0].run_after - now).total_seconds(), 0.01))
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            except Exception as e:
+                print("Error dispatching jobs", e)
+                await asyncio.sleep(5)
+
+    async def _work(self):
+        while True:
+            job: Job = await self._ready.get()
+            self._running += 1
+            started = time.monotonic()
+            if job.run_after is not None:
+                waited = max((datetime.now(timezone.utc) - job.run_after).total_seconds(), 0)
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            try:
+                handler = self._handlers.get(job.kind)
+                if handler is None:
+                    raise ValueError("No handler for jobs of kind " + job.kind)
+                await handler(job.key)
+                await self._finish(job)
+                self._completed += 1
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                try:
+                    await self._retry(job, e)
+                except Exception as e:
+                    print("Error rescheduling job", job.id, e)
+            finally:
+                duration = time.monotonic() - started
+                self._run_total += duration
+                self._run_max = max(self._run_max, duration)
+                self._running -= 1
+
+    async def _finish(self, job: Job):
+        if not await self.db.execute("DELETE FROM job WHERE id=? AND generation=?", [job.id, job.generation]):
+            # It was queued again while running, so run it again
+            await self.db.execute("UPDATE job SET status='pending' WHERE id=?", [job.id])
+            self._wake.set()
+
+    async def _retry(self, job: Job, error: Exception):
+        attempts = job.attempts + 1
+        if attempts >= self.max_attempts:
+            print("Giving up on job", job.id, "after", attempts, "attempts")
+            self._failed += 1
+            await self.db.execute("DELETE FROM job WHERE id=? AND generation=?", [job.id, job.generation])
+            await self.db.execute("UPDATE job SET status='pending' WHERE id=?", [job.id])
+            return
+        self._retried += 1
+        run_after = datetime.now(timezone.utc) + timedelta(seconds=self.retry_delay * 2 ** job.attempts)
+        await self.db.execute("UPDATE job SET status='pending', attempts=?, run_after=?, last_error=? WHERE id=?",
+                              [attempts, str(run_after), str(error), job.id])
+
+    async def stats(self) -> Dict[str, Any]:
+        pending = await self.db.count(Job, "status='pending'", [])
+        finished = self._completed + self._failed + self._retried
+        return {
+            "pending": pending,
+            "running": self._running,
+            "completed": self._completed,
+            "retried": self._retried,
+            "failed": self._failed,
+            "average_wait_seconds": self._wait_total / finished if finished else 0,
+            "max_wait_seconds": self._wait_max,
+            "average_run_seconds": self._run_total / finished if finished else 0,
+            "max_run_seconds": self._run_max
+        }
@@ -0,0 +1,106 @@
+import sys
+import os.path
+import threading
+import time
+import functools
+from collections import Counter
+from contextvars import ContextVar
+from typing import Dict, Union, Callable
+
+# Timings for the request currently being profiled, or None when profiling isn't enabled for it.
+_timings: ContextVar[Union[Dict[str, float], None]] = ContextVar("timings", default=None)
+
+
+def start_timings() -> Dict[str, float]:
+    """Enables timing collection for the current request (and any tasks it creates afterward)"""
+    timings: Dict[str, float] = {}
+    _timings.set(timings)
+    return timings
+
+
+def current_timings() -> Union[Dict[str, float], None]:
+    return _timings.get()
+
+
+class timed():
+    """Context manager that adds the time spent inside it to the named timing, if the current request is being profiled"""
+    __slots__ = ["name", "timings", "started"]
+
+    def __init__(self, name: str):
+        self.name = name
+        self.timings = _timings.get()
+
+    def __enter__(self):
+        if self.timings is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *args):
+        if self.timings is not None:
+            self.timings[self.name] = self.timings.get(self.name, 0) + time.perf_counter() - self.started
+
+
+def profiled(name: str):
+    """Decorator that records the time spent in a coroutine function under the named timing"""
+    def decorator(func: Callable):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _timings.get() is None:
+                return await func(*args, **kwargs)
+            with timed(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """Formats timings (in seconds) as a Server-Timing header, which browsers show in their developer tools"""
+    return ", ".join(["{};dur={:.2f}".format(name, seconds * 1000) for name, seconds in timings.items()])
+
+
+class SamplingProfiler():
+    """
+    Periodically samples the stack of a single thread (by default the one that created it, ie the event loop)
+    from a background thread, and reports how often each stack was seen in the collapsed format flamegraph tools read.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Union[int, None] = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples: Counter = Counter()
+        self.started: Union[float, None] = None
+        self.stopped: Union[float, None] = None
+        self._stop = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float):
+        self.started = time.time()
+        self._thread = threading.Thread(target=self._run, args=(seconds,), name="SamplingProfiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self, seconds: float):
+        end = time.perf_counter() + seconds
+        while not self._stop.is_set() and time.perf_counter() < end:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+            del frame
+            self._stop.wait(self.interval)
+        self.stopped = time.time()
+
+    def collapsed(self) -> str:
+        return "".join(["{} {}\n".format(stack, count) for stack, count in self.samples.most_common()])
@@ -1,4 +1,5 @@
 import aiohttp.web as web
+from aiohttp import WSCloseCode, WSMsgType
 import os
 import openai
 import asyncio
@@ -7,12 +8,22 @@ import threading
 import uuid
 import tiktoken
 import random
+import hashlib
+import time
+import math
 import os.path
-from typing import Union, Dict, List, Any
-from dataclasses import dataclass
+from typing import Union, Dict, List, Any, Callable, Awaitable, Tuple
+from dataclasses import dataclass, fields
 from .database import SQLiteDB
-from .database_classes import User as DBUSer, Chat as DBChat, Session as DBSession, UserBasic
+from .database_classes import User as DBUSer, Chat as DBChat, Session as DBSession, DeletedChat as DBDeletedChat, UserBasic
+from .database_classes import Global as DBGlobal, Usage as DBUsage, UsageRollup as DBUsageRollup
 from .dataclass_encoder import CustomJSONTransformer
+from .expiring import ExpiringDict
+from .stream_buffer import CompletionBuffer, CompletionBuffers
+from .context import ContextPlanner, ContextPlan
+from .jobs import JobQueue
+from .compression import choose_encoding, compress, StreamCompressor
+from .profiling import SamplingProfiler, start_timings, current_timings, timed, server_timing_header
 from datetime import datetime, timedelta, timezone
 from uuid import uuid4
 from bsrp.server import (
@@ -37,6 +48,33 @@ GPT5_NANO = "gpt-5.4-nano"
 
 MODEL_DEFAULT = GPT5_NANO
 
+# How far behind the current time the cursor returned by the chat changes feed is
+CHANGES_MARGIN_SECONDS = 30
+# Tombstones of deleted chats are kept this long.  Clients syncing from before then get the full list instead.
+TOMBSTONE_MAX_AGE_DAYS = 90
+
+# Number of chats written to the database per transaction during a bulk import
+IMPORT_BATCH_SIZE = 200
+
+# Longest an admin can run the sampling profiler for
+MAX_PROFILE_SECONDS = 600
+MIN_PROFILE_INTERVAL_MS = 1
+
+# How long a login challenge is valid for, and how many can be outstanding at once
+CHALLENGE_TTL_SECONDS = 30
+MAX_CHALLENGES = 1000
+
+# Sessions are stored in the database, and recently used ones are cached in memory
+SESSION_CACHE_TTL_SECONDS = 60 * 60
+MAX_CACHED_SESSIONS = 10000
+
+# Responses smaller than this aren't worth compressing, and ones larger than this are compressed off the event loop
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_OFFLOAD_BYTES = 64 * 1024
+
+# How much of a streamed response is gathered before it's written out
+STREAM_CHUNK_BYTES = 64 * 1024
+
 
 @dataclass
 class OpenAiModel:
@@ -72,10 +110,46 @@ MODELS: Dict[str, OpenAiModel] = {
 
 DEFAULT_SYSTEM_MESSAGE = "You are a helpful and concise assistant."
 
+# How long a completion keeps running after its client disconnects, waiting for it to resume
+DETACHED_STREAM_GRACE_SECONDS = 120
+# Finished completions are kept for resuming until they're this old, or the total size of all of them gets too big
+FINISHED_STREAM_MAX_AGE_SECONDS = 10 * 60
+MAX_STREAM_BUFFER_BYTES = 50 * 1024 * 1024
+MAX_BYTES_PER_STREAM = 4 * 1024 * 1024
+# Close codes a client sends when it closes the socket itself, rather than losing the connection.  Browsers send a
+# close frame without a code from close(), which is reported as 0.
+CLIENT_CLOSE_CODES = [0, WSCloseCode.OK, WSCloseCode.GOING_AWAY]
+
+# Default limit on prompt tokens sent upstream.  Older messages that don't fit are left out.
+PROMPT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 0)) or None
+# When asked to, history that doesn't fit is replaced by a summary from this model.  History is dropped in blocks of
+# messages so the same summary can be reused for several turns.
+SUMMARY_MODEL = GPT5_NANO
+SUMMARY_MAX_TOKENS = 1024
+SUMMARY_BLOCK_SIZE = 8
+SUMMARY_PROMPT = "Summarize the following conversation so the summary can stand in for it.  Be concise, but keep facts, decisions, code, and open questions that later messages may refer to."
+
+# Background jobs.  Chats get named a while after they're saved, so a burst of saves only names them once.
+JOB_WORKERS = 2
+NAME_CHAT_JOB = "name_chat"
+NAME_CHAT_DELAY_SECONDS = 60
+# A title is only a few tokens, but this also has to leave room for the model's reasoning
+NAME_MAX_TOKENS = 256
+NAME_PROMPT = "Write a short title, at most six words, for the following conversation.  Reply with only the title."
+
 
 class ChatStreamManager():
-    def __init__(self, ws: web.WebSocketResponse):
+    def __init__(self, ws: web.WebSocketResponse, buffers: CompletionBuffers, context: ContextPlanner, user_id: str = "",
+                 on_usage: Union[Callable[[DBUsage], Awaitable[None]], None] = None):
         self._ws = ws
+        self._buffers = buffers
+        self._context = context
+        self._user_id = user_id
+        self._on_usage = on_usage
+        # The completions this connection is following, keyed by model
+        self._streams: Dict[str, CompletionBuffer] = {}
+        # Summaries being generated, keyed by the history they cover, so fanned out models share them
+        self._summaries: Dict[str, asyncio.Task] = {}
         self._read_task = None
         self._write_task = None
         self._completion_task = None
@@ -90,13 +164,40 @@ class ChatStreamManager():
         self._write_task = asyncio.create_task(self.handleWriting())
 
     async def handleReading(self):
-        async for msg in self._ws:
+        while True:
+            msg = await self._ws.receive()
+            if msg.type != WSMsgType.TEXT:
+                break
             if not self._run:
                 return
             if msg.data == 'cancel':
-                await self.stop()
+                if self._cancel_running() == 0:
+                    await self.stop()
                 continue
-            await self.handle_chat(json.loads(msg.data))
+            data = json.loads(msg.data)
+            if 'cancel' in data:
+                # Cancels just one model's completion when fanning out
+                buffer = self._streams.get(data['cancel'])
+                if buffer is not None and buffer.task is not None:
+                    buffer.task.cancel()
+            elif 'resume' in data:
+                await self.handle_resume(data)
+            else:
+                await self.handle_chat(data)
+        if msg.type == WSMsgType.CLOSE and msg.data in CLIENT_CLOSE_CODES:
+            # The client closed the socket on purpose, which is how it stops a response
+            self._cancel_running()
+        # Otherwise the connection dropped, and running completions keep going so they can be resumed from another connection
+        await self.stop()
+
+    def _cancel_running(self) -> int:
+        """Cancels this connection's running completions and any summaries they're waiting on, returning how many were running"""
+        running = [b for b in self._streams.values() if b.task is not None and not b.finished]
+        for buffer in running:
+            buffer.task.cancel()
+        for task in self._summaries.values():
+            task.cancel()
+        return len(running)
 
     async def handleWriting(self):
         while not self._stopwriting:
@@ -105,7 +206,8 @@ class ChatStreamManager():
 
     async def _handle_write(self, data: Any):
         if not isinstance(data, str):
-            data = json.dumps(data)
+            with timed("json"):
+                data = json.dumps(data)
         # TODO: consider emptying the queue
         await self._write_queue.put(data)
 
@@ -117,53 +219,178 @@ class ChatStreamManager():
         if len(prompt) == 0:
             prompt = DEFAULT_SYSTEM_MESSAGE
         messages = data['messages']
-        model = data.get('model', MODEL_DEFAULT)
+        # Sending a list of 'models' instead of one 'model' streams the same prompt to all of them at once
+        models = data.get('models') or [data.get('model', MODEL_DEFAULT)]
         max_tokens = data['max_tokens']
         message_start = data.get("continuation", "")
+        chat_id = data.get("chat_id", "")
         api_key = data.get("api_key", os.environ.get('OPENAI_API_KEY'))
         if len(api_key) == 0:
             api_key = os.environ.get('OPENAI_API_KEY', "")
+        summarize = data.get('summarize', False)
+        prompt_budget = data.get('prompt_budget') or PROMPT_TOKEN_BUDGET
         # Format a chat request to the OpenAI API
-        api_messages: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(content=prompt, role="system")]
-        model_data = self._getModel(model)
+        system = ChatCompletionSystemMessageParam(content=prompt, role="system")
+        history: list[ChatCompletionMessageParam] = []
         temperature = data.get('temperature', 1.0)
         for message in messages:
             role = message.get("role", "user")
             if role == "user":
-                api_messages.append(ChatCompletionUserMessageParam(
+                history.append(ChatCompletionUserMessageParam(
                     content=message.get("message", ""), role="user"))
             else:
-                api_messages.append(ChatCompletionAssistantMessageParam(
+                history.append(ChatCompletionAssistantMessageParam(
                     content=message.get("message", ""), role="assistant"))
-        task = self.request_chat(message_start, model_data, api_key, api_messages, temperature, max_tokens)
-        self._completion_task = asyncio.create_task(task)
 
-    async def request_chat(self, message_start: str, model_data: OpenAiModel, api_key: str, messages: list[ChatCompletionMessageParam], temperature: float, max_tokens: int):
-        prompt_tokens = model_data.tokenCount(
-            json.dumps(messages, separators=(',', ':')))
-
-        max_allowed = model_data.maxTokens - prompt_tokens
-        if (max_tokens > max_allowed):
-            max_tokens = max_allowed
+        for model in models:
+            model_data = self._getModel(model)
+            stream_id = self.id if len(models) == 1 else "{}-{}".format(self.id, model_data.value)
+            if model_data.value in self._streams:
+                await self._handle_write({
+                    'message': '',
+                    'finish_reason': None,
+                    'id': stream_id,
+                    'model': model_data.value,
+                    'role': 'assistant',
+                    'error': "A response from this model is already streaming on this connection"
+                })
+                continue
+            # Never plan a prompt that leaves no room for the completion
+            budget = model_data.maxTokens - min(max_tokens, model_data.maxTokens // 2)
+            if prompt_budget:
+                budget = min(budget, int(prompt_budget))
+            # Per-message token counts are cached, so models sharing an encoding only tokenize the history once
+            with timed("tokenize"):
+                plan = self._context.plan(model_data, system, history, budget,
+                                          SUMMARY_MAX_TOKENS if summarize else 0, SUMMARY_BLOCK_SIZE if summarize else 1)
+            buffer = self._buffers.create(stream_id, self._user_id, model_data.value)
+            buffer.attach(self._handle_write)
+            task = self.request_chat(buffer, chat_id, message_start, model_data, api_key, plan, summarize, temperature, max_tokens)
+            buffer.task = asyncio.create_task(task)
+            self._streams[model_data.value] = buffer
+        self._wait_for_streams()
+
+    async def _add_summary(self, plan: ContextPlan, model_data: OpenAiModel, api_key: str, chat_id: str):
+        """Replaces the plan's dropped history with a summary, only summarizing messages no cached summary covers"""
+        self._context.find_summary(plan, SUMMARY_BLOCK_SIZE)
+        summary = plan.covered_summary
+        if plan.covered < plan.trimmed:
+            task = self._summaries.get(plan.prefix_keys[-1])
+            if task is None:
+                task = asyncio.create_task(self._summarize(plan.covered_summary, plan.dropped[plan.covered:], api_key, chat_id))
+                self._summaries[plan.prefix_keys[-1]] = task
+            try:
+                # Shielded so cancelling one model's completion doesn't cancel a summary another one is waiting on
+                summary = await asyncio.shield(task)
+            except Exception as e:
+                # Just send the trimmed history instead
+                traceback.print_exception(type(e), e, e.__traceback__)
+                return
+            self._context.store_summary(plan, summary)
+        self._context.use_summary(model_data, plan, summary)
+
+    async def _summarize(self, previous: Union[str, None], messages: List[ChatCompletionMessageParam], api_key: str, chat_id: str) -> str:
+        model_data = MODELS[SUMMARY_MODEL]
+        transcript = "\n\n".join(["{}: {}".format(m["role"], m["content"]) for m in messages])
+        if previous is not None:
+            transcript = "Summary of the conversation before this: " + previous + "\n\n" + transcript
+        client = AsyncOpenAI(api_key=api_key)
+        response = await client.chat.completions.create(model=model_data.value, max_completion_tokens=SUMMARY_MAX_TOKENS, messages=[
+            ChatCompletionSystemMessageParam(content=SUMMARY_PROMPT, role="system"),
+            ChatCompletionUserMessageParam(content=transcript, role="user")])
+        if response.usage is not None:
+            await self._record_usage(chat_id, model_data, response.usage.prompt_tokens, response.usage.completion_tokens,
+                                     response.usage.prompt_tokens * model_data.token_cost_prompt + response.usage.completion_tokens * model_data.token_cost_completion)
+        summary = response.choices[0].message.content
+        if not summary:
+            raise ValueError("The summary was empty")
+        return summary
+
+    async def handle_resume(self, data):
+        """Reattaches to a completion started on another connection, sending everything after the client's byte offset"""
+        buffer = self._buffers.get(data['resume'])
+        if buffer is not None and (not self._user_id or buffer.user_id != self._user_id):
+            # Someone else's completion, which is treated the same as one that doesn't exist
+            buffer = None
+        if buffer is None or buffer.truncated:
+            await self._handle_write({
+                'message': '',
+                'finish_reason': None,
+                'id': data['resume'],
+                'role': 'assistant',
+                'error': "This response can no longer be resumed"
+            })
+            await self.stop()
+            return
+        self._streams[buffer.model] = buffer
+        buffer.attach(self._handle_write)
+        frame = buffer.replay(int(data.get('offset', 0)))
+        if frame is not None:
+            await self._handle_write(frame)
+        self._wait_for_streams()
+
+    def _wait_for_streams(self):
+        """Closes the connection once every completion it's following has finished, including ones added since last time"""
+        if self._completion_task is not None:
+            self._completion_task.cancel()
+        self._completion_task = asyncio.create_task(self._close_when_finished(list(self._streams.values())))
+
+    async def _close_when_finished(self, buffers: List[CompletionBuffer]):
+        for buffer in buffers:
+            await buffer.wait_finished()
+        await self.stop()
+
+    async def request_chat(self, buffer: CompletionBuffer, chat_id: str, message_start: str, model_data: OpenAiModel, api_key: str, plan: ContextPlan, summarize: bool, temperature: float, max_tokens: int):
+        prompt_tokens = plan.prompt_tokens
+        timings = current_timings()
+        started = time.perf_counter()
+        time_to_first_token = None
+        requested = False
         completion_tokens = 0
         if (len(message_start) > 0):
             message_start += " "
+        # Length of the message so far in utf-8 bytes, which is what clients give back when resuming
+        offset = len(message_start.encode())
         last_message = {
             'cost_tokens_completion': completion_tokens,
             'cost_tokens_prompt': prompt_tokens,
             'cost_usd': prompt_tokens * model_data.token_cost_prompt + completion_tokens * model_data.token_cost_completion,
             'message': message_start,
             'finish_reason': None,
-            'id': self.id,
+            'id': buffer.id,
+            'model': model_data.value,
+            'time_to_first_token': time_to_first_token,
+            'trimmed_messages': plan.trimmed,
+            'summarized': plan.summary is not None,
+            'offset': offset,
             'role': 'assistant'
         }
         try:
+            if summarize and plan.trimmed > 0:
+                # Let the client know the completion has started, since summarizing can take a while
+                await buffer.publish(dict(last_message, summarizing=True))
+                await self._add_summary(plan, model_data, api_key, chat_id)
+                prompt_tokens = plan.prompt_tokens
+                last_message['cost_tokens_prompt'] = prompt_tokens
+                last_message['cost_usd'] = prompt_tokens * model_data.token_cost_prompt
+                last_message['summarized'] = plan.summary is not None
+            messages = plan.messages()
+            max_allowed = max(model_data.maxTokens - prompt_tokens, 1)
+            if (max_tokens > max_allowed):
+                max_tokens = max_allowed
             client = AsyncOpenAI(api_key=api_key)
+            waiting = time.perf_counter()
             stream = await client.chat.completions.create(messages=messages, model=model_data.value, stream=True, temperature=temperature, max_completion_tokens=max_tokens)
+            requested = True
             full_message = message_start
             async for chunk in stream:
-                full_message += chunk.choices[0].delta.content or ""
+                if timings is not None:
+                    timings["upstream"] = timings.get("upstream", 0) + time.perf_counter() - waiting
+                content = chunk.choices[0].delta.content or ""
+                if time_to_first_token is None and len(content) > 0:
+                    time_to_first_token = time.perf_counter() - started
+                full_message += content
+                offset += len(content.encode())
                 completion_tokens += 1
                 last_message = {
                     'cost_tokens_completion': completion_tokens,
@@ -171,42 +398,75 @@ class ChatStreamManager():
                     'cost_usd': prompt_tokens * model_data.token_cost_prompt + completion_tokens * model_data.token_cost_completion,
                     'message': full_message,
                     'finish_reason': chunk.choices[0].finish_reason,
-                    'id': self.id,
+                    'id': buffer.id,
+                    'model': model_data.value,
+                    'time_to_first_token': time_to_first_token,
+                    'trimmed_messages': plan.trimmed,
+                    'summarized': plan.summary is not None,
+                    'offset': offset,
                     'role': 'assistant'
                 }
-                await self._handle_write(last_message)
+                await buffer.publish(last_message)
+                if buffer.detached_for() > DETACHED_STREAM_GRACE_SECONDS:
+                    print("Abandoning completion", buffer.id, "since no client has resumed it")
+                    break
+                waiting = time.perf_counter()
+            if timings is not None:
+                # Profiled streams report their timing breakdown in one last frame
+                last_message["timings"] = dict(timings)
+                await buffer.publish(last_message)
+        except asyncio.CancelledError:
+            last_message["finish_reason"] = "cancelled"
+            await buffer.publish(last_message)
+            raise
         except Exception as e:
             last_message["error"] = str(e)
             traceback.print_exception(type(e), e, e.__traceback__)
-            await self._handle_write(last_message)
+            await buffer.publish(last_message)
         finally:
-            await self.stop()
+            if requested:
+                await self._record_usage(chat_id, model_data, prompt_tokens, completion_tokens, last_message['cost_usd'])
+            buffer.finish()
+
+    async def _record_usage(self, chat_id: str, model_data: OpenAiModel, prompt_tokens: int, completion_tokens: int, cost_usd: float):
+        if self._on_usage is None or not self._user_id:
+            # Without a session there's no one to attribute the usage to
+            return
+        try:
+            await self._on_usage(DBUsage(str(uuid4()), self._user_id, chat_id, model_data.value, prompt_tokens,
+                                         completion_tokens, cost_usd, datetime.now(timezone.utc)))
+        except Exception as e:
+            print("Error recording usage", e)
 
-    async def stop(self, error=None):
+    async def stop(self):
+        """Closes the connection.  A running completion isn't cancelled, so it can be resumed from another connection."""
+        if self._stop.is_set():
+            return
         self._stop.set()
         self._run = False
-        if self._completion_task is not None:
+        for buffer in self._streams.values():
+            buffer.detach(self._handle_write)
+        current = asyncio.current_task()
+        if self._completion_task is not None and self._completion_task is not current:
             self._completion_task.cancel()
-            await self._completion_task
-        if self._read_task is not None:
+        if self._read_task is not None and self._read_task is not current:
             self._read_task.cancel()
-            await self._read_task
-        self._stopwriting = True
+        # Give queued frames a chance to go out before closing
         for i in range(10):
-            if not self._write_queue.empty():
-                await asyncio.sleep(200)
+            if not self._write_queue.empty() and not self._write_task.done() and not self._ws.closed:
+                await asyncio.sleep(0.2)
             else:
                 break
+        self._stopwriting = True
         if self._write_task:
             self._write_task.cancel()
-            await self._write_task
         await self._ws.close()
 
     async def closed(self):
         await self._stop.wait()
 
 
-@dataclass
+@dataclass(slots=True)
 class ChallengeInfo():
     b: int
     B: int
@@ -220,16 +480,25 @@ class Server():
     def __init__(self, database: SQLiteDB):
         self.db = database
         self.transformer = CustomJSONTransformer()
-        self.sessions: Dict[str, DBSession] = {}
-        self.challenges: Dict[int, ChallengeInfo] = {}
+        self.sessions: ExpiringDict[str, DBSession] = ExpiringDict(
+            SESSION_CACHE_TTL_SECONDS, MAX_CACHED_SESSIONS, sliding=True)
+        self.challenges: ExpiringDict[int, ChallengeInfo] = ExpiringDict(
+            CHALLENGE_TTL_SECONDS, MAX_CHALLENGES)
         self._authLock: asyncio.Lock = asyncio.Lock()
         self._purgeTask: Union[asyncio.Task, None] = None
+        self._profiler: Union[SamplingProfiler, None] = None
+        self.completions = CompletionBuffers(
+            FINISHED_STREAM_MAX_AGE_SECONDS, MAX_STREAM_BUFFER_BYTES, MAX_BYTES_PER_STREAM)
+        self.context = ContextPlanner()
+        # Names of users allowed to use admin-only features, like profiling
+        self._admins = set(name.strip().lower() for name in os.environ.get("ADMIN_USERS", "").split(",") if name.strip())
 
-        # an async queue used to do name generation for chats
-        self._nameQueue: asyncio.Queue = asyncio.Queue()
+        # background work, like generating names for chats
+        self.jobs = JobQueue(database, workers=JOB_WORKERS)
+        self.jobs.register(NAME_CHAT_JOB, self.name_chat)
 
     async def start(self):
-        app = web.Application()
+        app = web.Application(middlewares=[self.profiling_middleware, self.compression_middleware])
         app.add_routes([
             web.static('/static', self.get_path('static'), show_index=False),
             web.get('/', self.index),
@@ -239,44 +508,32 @@ class Server():
             web.get('/manifest.json', self.manifest),
             web.get('/api/initialize', self.initialize),
             web.post('/api/chats', self.get_chats),
+            web.get('/api/chats/changes', self.get_chat_changes),
+            web.post('/api/chats/batch', self.batch_chats),
             web.post('/api/chat', self.save_chat),
             web.get('/api/chat/{id}', self.query_chat),
             web.get('/api/user/{id}', self.query_user),
             web.post('/api/user', self.add_user),
             web.delete('/api/chat/{id}', self.delete_chat),
+            web.get('/api/export', self.export_chats),
+            web.post('/api/import', self.import_chats),
             web.post('/api/login/step1', self.authStep1),
             web.post('/api/login/step2', self.authStep2),
             web.get('/api/ws/chat', self.websocket_stream_handler),
+            web.get('/api/usage', self.get_usage),
+            web.post('/api/admin/profile/start', self.start_profile),
+            web.post('/api/admin/profile/stop', self.stop_profile),
+            web.get('/api/admin/profile', self.get_profile),
+            web.get('/api/admin/memory', self.get_memory),
+            web.get('/api/admin/jobs', self.get_jobs),
         ])
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, "0.0.0.0", int(os.environ.get("PORT", 80)))
         await site.start()
-        print("Loading Sessions")
-        self.sessions = {s.session_id: s for s in await self.db.get_all(DBSession)}
         print("Server Started")
         self._purgeTask = asyncio.create_task(self.purgeSessions())
-
-    # async def process_chat_name_queue(self):
-    #     while True:
-    #         try:
-    #             chat_id = await self._nameQueue.get()
-
-    #             # Make a request to the AI to generate a summary of the conversation, using a truncated version of the conversation
-    #             # This is done to prevent the AI from generating a summary that is too long
-    #             chat = await self.db.find_by_id(DBChat, chat_id)
-    #             if chat is None:
-    #                 continue
-    #             chat_messages = json.loads(chat.data)
-    #             ai_messages = []
-    #             for message in chat_messages:
-    #                 if message['role'] == 'assistant':
-    #                     ai_messages.append(message['message'])
-
-    #             await self.db.update(DBChat, chat_id, name=name)
-    #         except Exception as e:
-    #             await asyncio.sleep(5)
-    #             print(e)
+        await self.jobs.start()
 
     # takes in a path and returns the fully qualified path relative to this file
     def get_path(self, path):
@@ -292,22 +549,157 @@ class Server():
         return web.FileResponse(self.get_path('workbox-d249b2c8.js'))
 
     async def purgeSessions(self):
-        """Purges old sessions from the database, once per hour"""
+        """
+        Purges old sessions and tombstones of deleted chats from the database, once per hour.  Challenges and cached
+        sessions expire on their own.
+        """
         while True:
             try:
-                for session in filter(lambda s: s.last_used < datetime.now(timezone.utc) - timedelta(days=37), list(self.sessions.values())):
+                for session in filter(lambda s: s.last_used is None or s.last_used < datetime.now(timezone.utc) - timedelta(days=37), await self.db.get_all(DBSession)):
                     await self.db.delete(session)
-                    self.sessions.pop(session.session_id)
+                    self.sessions.pop(session.session_id, None)
             except Exception as e:
                 print("Error purging sessions", e)
-
             try:
-                for challenge in filter(lambda s: s.started < datetime.now(timezone.utc) - timedelta(minutes=1), list(self.challenges.values())):
-                    self.challenges.pop(challenge.B)
+                cutoff = datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_MAX_AGE_DAYS)
+                await self.db.execute("DELETE FROM deletedchat WHERE deleted < ?", [str(cutoff)])
             except Exception as e:
-                print("Error purging sessions", e)
+                print("Error purging tombstones", e)
             await asyncio.sleep(60 * 60)
 
+    async def is_admin(self, req: web.Request) -> bool:
+        if len(self._admins) == 0:
+            return False
+        session = await self.validate_session(req)
+        if not session:
+            return False
+        user = await self.db.find_by_id(DBUSer, session.user_id)
+        return user is not None and user.name.lower() in self._admins
+
+    @web.middleware
+    async def profiling_middleware(self, req: web.Request, handler):
+        """Records a timing breakdown for admin requests sent with an X-Profile header (or a 'profile' query parameter, for websockets)"""
+        if ('X-Profile' not in req.headers and 'profile' not in req.query) or not await self.is_admin(req):
+            return await handler(req)
+        timings = start_timings()
+        started = time.perf_counter()
+        resp = await handler(req)
+        timings["total"] = time.perf_counter() - started
+        if not resp.prepared:
+            resp.headers["Server-Timing"] = server_timing_header(timings)
+        return resp
+
+    @web.middleware
+    async def compression_middleware(self, req: web.Request, handler):
+        """Compresses large responses for clients that accept it.  Streamed responses enable their own compression."""
+        resp = await handler(req)
+        if (not isinstance(resp, web.Response) or resp.prepared or not isinstance(resp.body, bytes)
+                or len(resp.body) < COMPRESS_MIN_BYTES or 'Content-Encoding' in resp.headers):
+            return resp
+        resp.headers.add("Vary", "Accept-Encoding")
+        encoding = choose_encoding(req.headers.get('Accept-Encoding', ""))
+        if encoding is None:
+            return resp
+        with timed("compress"):
+            if len(resp.body) >= COMPRESS_OFFLOAD_BYTES:
+                body = await asyncio.get_running_loop().run_in_executor(None, compress, resp.body, encoding)
+            else:
+                body = compress(resp.body, encoding)
+        resp.body = body
+        resp.headers["Content-Encoding"] = encoding
+        etag = resp.headers.get("ETag")
+        if etag is not None and not etag.startswith("W/"):
+            # The compressed bytes differ from the original, so it's only the same resource, not the same representation
+            resp.headers["ETag"] = "W/" + etag
+        return resp
+
+    async def start_profile(self, req: web.Request):
+        """Starts sampling the event loop's stack, for at most the given number of seconds"""
+        if not await self.is_admin(req):
+            return web.Response(status=401)
+        if self._profiler is not None and self._profiler.running:
+            return web.json_response({"error": "Already profiling"}, status=409)
+        try:
+            data = await req.json() if req.can_read_body else {}
+            seconds = float(data.get("seconds", 30))
+            interval_ms = float(data.get("interval_ms", 5))
+        except (ValueError, TypeError, AttributeError):
+            return web.json_response({"error": "Invalid seconds or interval_ms"}, status=400)
+        if not math.isfinite(seconds) or seconds <= 0 or not math.isfinite(interval_ms):
+            return web.json_response({"error": "Invalid seconds or interval_ms"}, status=400)
+        seconds = min(seconds, MAX_PROFILE_SECONDS)
+        # Sampling more often than this would starve the event loop of the GIL
+        interval_ms = max(interval_ms, MIN_PROFILE_INTERVAL_MS)
+        self._profiler = SamplingProfiler(interval=interval_ms / 1000)
+        self._profiler.start(seconds)
+        return web.json_response({"seconds": seconds})
+
+    async def stop_profile(self, req: web.Request):
+        if not await self.is_admin(req):
+            return web.Response(status=401)
+        if self._profiler is None:
+            return web.Response(status=404)
+        self._profiler.stop()
+        return web.json_response({"samples": sum(self._profiler.samples.values())})
+
+    async def get_profile(self, req: web.Request):
+        """Downloads the last profile in collapsed stack format, which can be read by flamegraph.pl or speedscope"""
+        if not await self.is_admin(req):
+            return web.Response(status=401)
+        if self._profiler is None:
+            return web.Response(status=404)
+        return web.Response(text=self._profiler.collapsed(), headers={
+            "Content-Disposition": 'attachment; filename="profile.folded"'
+        })
+
+    async def get_memory(self, req: web.Request):
+        """Reports how much memory the in-memory session and challenge maps are using"""
+        if not await self.is_admin(req):
+            return web.Response(status=401)
+        return web.json_response({
+            "sessions": self.sessions.stats(),
+            "challenges": self.challenges.stats(),
+            "streams": self.completions.stats(),
+            "context": self.context.stats()
+        })
+
+    async def get_jobs(self, req: web.Request):
+        """Reports the background job queue's depth and how long jobs wait and run for"""
+        if not await self.is_admin(req):
+            return web.Response(status=401)
+        return web.json_response(await self.jobs.stats())
+
+    async def name_chat(self, chat_id: str):
+        """Background job that asks the AI for a name for a chat that doesn't have one"""
+        found = await self.db.find(DBChat, id=chat_id)
+        if len(found) == 0:
+            return
+        chat = found[0]
+        if chat.name or chat.automatic_name:
+            return
+        messages = json.loads(chat.data or "[]")
+        if len(messages) == 0:
+            return
+        users = await self.db.find(DBUSer, id=chat.user_id)
+        api_key = users[0].api_key if len(users) > 0 and users[0].api_key else os.environ.get('OPENAI_API_KEY', "")
+        if not api_key:
+            return
+        # The start of a conversation is enough to name it
+        transcript = "\n\n".join(["{}: {}".format(m.get("role", "user"), m.get("message", "")) for m in messages])[:4000]
+        model_data = MODELS[SUMMARY_MODEL]
+        client = AsyncOpenAI(api_key=api_key)
+        response = await client.chat.completions.create(model=model_data.value, max_completion_tokens=NAME_MAX_TOKENS, messages=[
+            ChatCompletionSystemMessageParam(content=NAME_PROMPT, role="system"),
+            ChatCompletionUserMessageParam(content=transcript, role="user")])
+        if response.usage is not None:
+            await self.record_usage(DBUsage(str(uuid4()), chat.user_id, chat.id, model_data.value, response.usage.prompt_tokens,
+                                            response.usage.completion_tokens, response.usage.prompt_tokens * model_data.token_cost_prompt +
+                                            response.usage.completion_tokens * model_data.token_cost_completion, datetime.now(timezone.utc)))
+        name = (response.choices[0].message.content or "").strip().strip('"').strip()[:100]
+        if not name:
+            raise ValueError("The generated name was empty")
+        await self.db.update_fields(DBChat, chat.id, automatic_name=name, last_saved=datetime.now(timezone.utc))
+
     async def manifest(self, req: web.Request):
         return web.json_response({
             "name": "AI Chat",
@@ -357,7 +749,11 @@ class Server():
             return None
         session = self.sessions.get(session_id)
         if not session:
-            return None
+            found = await self.db.find(DBSession, session_id=session_id)
+            if len(found) == 0 or found[0].last_used is None:
+                return None
+            session = found[0]
+            self.sessions[session.session_id] = session
         if session.user_id != user_id:
             return None
         if session.last_used < datetime.now(timezone.utc) - timedelta(days=37):
@@ -379,40 +775,360 @@ class Server():
         query = await req.json()
         if not await self.validate_session(req, user_id=query.get('user_id')):
             return web.Response(status=401)
+        # Written out as the rows are read, so users with many chats don't need the whole list in memory
+        resp = web.StreamResponse(headers={"Content-Type": "application/json; charset=utf-8"})
+        compressor = await self.start_stream(req, resp)
+        chunk = bytearray(b'{"chats": [')
+        first = True
+        async for chat in self.db.iterate(DBChat, find_fields=DBChat.REQUIRED, user_id=query['user_id']):
+            if not first:
+                chunk += b", "
+            first = False
+            chunk += self.transformer.to_json(chat).encode()
+            if len(chunk) >= STREAM_CHUNK_BYTES:
+                await self.write_stream(resp, compressor, bytes(chunk))
+                chunk.clear()
+        chunk += b"]}"
+        await self.write_stream(resp, compressor, bytes(chunk), last=True)
+        return resp
+
+    async def start_stream(self, req: web.Request, resp: web.StreamResponse) -> Union[StreamCompressor, None]:
+        """Starts a chunked response, compressed if the client accepts it, and returns its compressor"""
+        resp.enable_chunked_encoding()
+        resp.headers.add("Vary", "Accept-Encoding")
+        compressor = None
+        encoding = choose_encoding(req.headers.get('Accept-Encoding', ""))
+        if encoding is not None:
+            resp.headers["Content-Encoding"] = encoding
+            compressor = StreamCompressor(encoding)
+        await resp.prepare(req)
+        return compressor
+
+    async def write_stream(self, resp: web.StreamResponse, compressor: Union[StreamCompressor, None], data: bytes, last: bool = False):
+        """Writes a chunk of a response started by start_stream, ending the response if it's the last one"""
+        if compressor is not None:
+            with timed("compress"):
+                data = await compressor.compress(data, last)
+        if len(data) > 0:
+            await resp.write(data)
+        if last:
+            await resp.write_eof()
+
+    def chat_from_json(self, info: Dict[str, Any]) -> DBChat:
+        """Converts a chat as sent by the client (with parsed messages and settings) into its database form"""
+        with timed("json"):
+            info['data'] = json.dumps(info["messages"])
+            info['settings'] = json.dumps(info["settings"])
+        del info['messages']
+        return DBChat(**info)
+
+    def chat_to_json(self, chat: DBChat) -> str:
+        """
+        Converts a chat from its database form into the json sent to the client.  Messages and settings are
+        already stored as json text, so they get spliced into the output as-is instead of being parsed and re-encoded.
+        """
+        with timed("json"):
+            envelope = self.transformer.encoder.default(chat)
+            del envelope["data"]
+            del envelope["settings"]
+            head = json.dumps(envelope)
+        return "".join([head[:-1], ', "settings": ', chat.settings or "{}", ', "messages": ', chat.data or "[]", "}"])
+
+    async def get_chat_changes(self, req: web.Request):
+        """
+        Returns the chats saved and the ids of chats deleted after the 'since' query parameter, an iso timestamp (UTC
+        unless it has an offset).  The returned 'now' should be passed as 'since' on the next request.  It lags behind
+        the current time, so changes may be returned more than once, and clients should apply them by id.  Without
+        'since', or when it's older than the tombstones that are kept, every chat is returned and 'full' is set, so
+        clients should drop any chat not in the list.
+        """
+        session = await self.validate_session(req, user_id=req.query.get('user_id'))
+        if not session:
+            return web.Response(status=401)
+        # Saves are timestamped a little before they commit, so a save still in progress now can be stamped earlier
+        # than this.  Going back by a margin makes sure it's picked up next time.
+        now = datetime.now(timezone.utc) - timedelta(seconds=CHANGES_MARGIN_SECONDS)
+        since = req.query.get('since')
+        find_fields = DBChat.REQUIRED + ["last_saved"]
+        if since:
+            try:
+                since = datetime.fromisoformat(since)
+            except ValueError:
+                return web.json_response({"error": "Invalid timestamp"}, status=400)
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            else:
+                # Timestamps are compared as text, so they have to be in the same zone as the stored ones
+                since = since.astimezone(timezone.utc)
+            if since < datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_MAX_AGE_DAYS):
+                # Deletions from back then may have been purged
+                since = None
+        if since:
+            chats = await self.db.find_after(DBChat, "last_saved", since, find_fields=find_fields, user_id=session.user_id)
+            deleted = await self.db.find_after(DBDeletedChat, "deleted", since, user_id=session.user_id)
+        else:
+            chats = await self.db.find(DBChat, find_fields=find_fields, user_id=session.user_id)
+            deleted = []
         data = {
-            "chats": await self.db.find(DBChat, find_fields=DBChat.REQUIRED, user_id=query['user_id'])
+            "chats": chats,
+            "deleted": [d.id for d in deleted],
+            "full": not since,
+            "now": now.replace(tzinfo=None).isoformat()
         }
         return web.json_response(data, dumps=self.transformer.to_json)
 
     async def save_chat(self, req: web.Request):
         info = await req.json()
-        info['data'] = json.dumps(info["messages"])
-        info['settings'] = json.dumps(info["settings"])
-        del info['messages']
-        chat = DBChat(**info)
+        chat = self.chat_from_json(info)
         if not await self.validate_session(req, user_id=chat.user_id):
             return web.Response(status=401)
         from_db = await self.db.find_by_id(DBChat, chat.id)
+        chat.last_saved = datetime.now(timezone.utc)
+        # The name is generated by the server, so whatever a client sends back (possibly from before it was named) is ignored
+        chat.automatic_name = ""
         if from_db:
             if from_db.user_id != chat.user_id:
                 return web.Response(status=401)
-            await self.db.update(chat)
-        else:
-            await self.db.insert(chat)
-        return web.json_response({})
+            chat.automatic_name = from_db.automatic_name
+            # The server adds to the total as completions finish, but only for completions it knows the chat and user of,
+            # so the client's running total can be ahead of it
+            chat.total_spending = max(float(chat.total_spending or 0), from_db.total_spending)
+        statements = [self.clear_tombstones([chat])]
+        if not chat.name and not chat.automatic_name:
+            statements.append(self.jobs.enqueue_statement(NAME_CHAT_JOB, [chat.id], NAME_CHAT_DELAY_SECONDS))
+        await self.db.write_batch([chat], [], statements)
+        return web.json_response({}, headers={"ETag": self.chat_etag(chat)})
+
+    async def batch_chats(self, req: web.Request):
+        """
+        Saves and deletes many chats in a single transaction.  Takes {"user_id", "upserts": [chats], "deletes": [chat ids]}
+        and returns a status for each item, in the order they were given.
+        """
+        data = await req.json()
+        session = await self.validate_session(req, user_id=data.get('user_id'))
+        if not session:
+            return web.Response(status=401)
+
+        chats: List[Union[DBChat, None]] = []
+        for info in data.get("upserts", []):
+            try:
+                chats.append(self.chat_from_json(info))
+            except Exception:
+                chats.append(None)
+        delete_ids: List[str] = [str(i) for i in data.get("deletes", [])]
+
+        # A single query to check ownership of everything in the batch
+        ids = list(set([c.id for c in chats if c is not None] + delete_ids))
+        existing = {c.id: c for c in await self.db.find_in(DBChat, "id", ids, find_fields=["id", "user_id", "automatic_name", "total_spending"])}
+        owners = {id: c.user_id for id, c in existing.items()}
+
+        now = datetime.now(timezone.utc)
+        to_upsert: List[Any] = []
+        to_delete: List[DBChat] = []
+        upsert_results = []
+        for chat in chats:
+            if chat is None:
+                upsert_results.append({"id": None, "status": "invalid"})
+            elif chat.user_id != session.user_id or owners.get(chat.id, session.user_id) != session.user_id:
+                upsert_results.append({"id": chat.id, "status": "unauthorized"})
+            else:
+                chat.last_saved = now
+                # Generated by the server, so never taken from clients
+                chat.automatic_name = ""
+                if chat.id in existing:
+                    chat.automatic_name = existing[chat.id].automatic_name
+                    chat.total_spending = max(float(chat.total_spending or 0), existing[chat.id].total_spending)
+                to_upsert.append(chat)
+                upsert_results.append({"id": chat.id, "status": "ok", "etag": self.chat_etag(chat)})
+        delete_results = []
+        for chat_id in delete_ids:
+            owner = owners.get(chat_id)
+            if owner is None:
+                delete_results.append({"id": chat_id, "status": "not_found"})
+            elif owner != session.user_id:
+                delete_results.append({"id": chat_id, "status": "unauthorized"})
+            else:
+                to_delete.append(DBChat(chat_id, owner))
+                to_upsert.append(DBDeletedChat(chat_id, owner, now))
+                delete_results.append({"id": chat_id, "status": "ok"})
+
+        saved = [c for c in to_upsert if isinstance(c, DBChat)]
+        unnamed = [c.id for c in saved if not c.name and not c.automatic_name]
+        await self.db.write_batch(to_upsert, to_delete, [
+            self.clear_tombstones(saved),
+            self.jobs.enqueue_statement(NAME_CHAT_JOB, unnamed, NAME_CHAT_DELAY_SECONDS)
+        ])
+        return web.json_response({"upserts": upsert_results, "deletes": delete_results})
+
+    def _has_last_saved(self, chat: DBChat) -> bool:
+        # Chats saved before last_saved was tracked have no usable value
+        return chat.last_saved is not None and chat.last_saved != datetime.min
+
+    def chat_etag(self, chat: DBChat) -> str:
+        """Returns the ETag for a chat, which changes every time it's saved"""
+        if self._has_last_saved(chat):
+            return '"{}"'.format(chat.last_saved.timestamp())
+        content = hashlib.sha1()
+        for value in [chat.name, chat.temporary_name, chat.automatic_name, chat.settings, chat.data]:
+            content.update(value.encode())
+            content.update(b"\0")
+        return '"{}"'.format(content.hexdigest())
+
+    def _etag_matches(self, req: web.Request, etag: str) -> bool:
+        for candidate in req.headers.get('If-None-Match', "").split(","):
+            candidate = candidate.strip()
+            if candidate.startswith("W/"):
+                candidate = candidate[2:]
+            if candidate == etag or candidate == "*":
+                return True
+        return False
 
     async def query_chat(self, req: web.Request):
-        chat = await self.db.find_by_id(DBChat, req.match_info.get("id"))
+        chat_id = req.match_info.get("id")
+        if 'If-None-Match' in req.headers:
+            # Check the version without loading the (possibly large) chat contents
+            found = await self.db.find(DBChat, find_fields=["id", "user_id", "last_saved"], id=chat_id)
+            if not found:
+                return web.Response(status=404)
+            if not await self.validate_session(req, user_id=found[0].user_id):
+                return web.Response(status=401)
+            etag = self.chat_etag(found[0])
+            if self._has_last_saved(found[0]) and self._etag_matches(req, etag):
+                return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+
+        chat = await self.db.find_by_id(DBChat, chat_id)
         if not chat:
             return web.Response(status=404)
         if not await self.validate_session(req, user_id=chat.user_id):
             return web.Response(status=401)
 
-        as_json = self.transformer.encoder.default(chat)
-        as_json["messages"] = json.loads(as_json["data"])
-        del as_json["data"]
-        as_json['settings'] = json.loads(as_json["settings"])
-        return web.json_response(as_json)
+        etag = self.chat_etag(chat)
+        if self._etag_matches(req, etag):
+            return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+        resp = web.Response(body=self.chat_to_json(chat).encode(), content_type="application/json", charset="utf-8")
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "private, no-cache"
+        if self._has_last_saved(chat):
+            resp.last_modified = chat.last_saved
+        return resp
+
+    async def export_chats(self, req: web.Request):
+        """Streams all of a user's chats as newline delimited json, one chat per line"""
+        session = await self.validate_session(req, user_id=req.query.get('user_id'))
+        if not session:
+            return web.Response(status=401)
+        resp = web.StreamResponse(headers={
+            "Content-Type": "application/x-ndjson",
+            "Content-Disposition": 'attachment; filename="chats.ndjson"'
+        })
+        compressor = await self.start_stream(req, resp)
+        chunk = bytearray()
+        async for chat in self.db.iterate(DBChat, user_id=session.user_id):
+            chunk += self.chat_to_json(chat).encode() + b"\n"
+            if len(chunk) >= STREAM_CHUNK_BYTES:
+                await self.write_stream(resp, compressor, bytes(chunk))
+                chunk.clear()
+        await self.write_stream(resp, compressor, bytes(chunk), last=True)
+        return resp
+
+    async def import_chats(self, req: web.Request):
+        """Reads newline delimited json chats (as produced by export_chats) into the session user's history"""
+        session = await self.validate_session(req, user_id=req.query.get('user_id'))
+        if not session:
+            return web.Response(status=401)
+        known_fields = set(f.name for f in fields(DBChat)) | {"messages"}
+        imported = 0
+        skipped = 0
+        batch: List[DBChat] = []
+
+        async def flush():
+            nonlocal imported, skipped
+            # Chats with an id already owned by another user are left untouched
+            changed = await self.db.upsert_many(batch, owner_field="user_id", statements=[self.clear_tombstones(batch)])
+            imported += changed
+            skipped += len(batch) - changed
+            batch.clear()
+
+        async for line in self._read_lines(req):
+            try:
+                info = {k: v for k, v in json.loads(line).items() if k in known_fields}
+                info['user_id'] = session.user_id
+                info['last_saved'] = datetime.now(timezone.utc)
+                info.setdefault('id', str(uuid4()))
+                info.setdefault('messages', [])
+                info.setdefault('settings', {})
+                batch.append(self.chat_from_json(info))
+            except Exception:
+                skipped += 1
+                continue
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await flush()
+        await flush()
+        return web.json_response({"imported": imported, "skipped": skipped})
+
+    async def _read_lines(self, req: web.Request):
+        """Yields the non-empty lines of a request body without buffering more than one line at a time"""
+        pending = bytearray()
+        async for chunk in req.content.iter_chunked(64 * 1024):
+            pending.extend(chunk)
+            end = pending.rfind(b"\n")
+            if end < 0:
+                continue
+            for line in bytes(pending[:end]).split(b"\n"):
+                if line.strip():
+                    yield line
+            del pending[:end + 1]
+        if pending.strip():
+            yield bytes(pending)
+
+    async def record_usage(self, usage: DBUsage):
+        """Appends a completion's usage to the ledger and adds it to the user's and the server's running totals"""
+        keys = [("total", ""), ("model", usage.model), ("day", usage.created.strftime("%Y-%m-%d"))]
+        if usage.chat_id:
+            keys.append(("chat", usage.chat_id))
+        rollups: List[Any] = [DBUsageRollup("{}/{}/{}".format(usage.user_id, kind, key), usage.user_id, kind, key, 1,
+                                            usage.prompt_tokens, usage.completion_tokens, usage.cost_usd) for kind, key in keys]
+        rollups.append(DBGlobal("total", usage.cost_usd))
+        spending = []
+        if usage.chat_id:
+            # Saving last_saved too changes the chat's ETag and puts it in the changes feed, so clients see the new total
+            spending.append((DBChat, {"total_spending": usage.cost_usd}, {"last_saved": datetime.now(timezone.utc)},
+                             {"id": usage.chat_id, "user_id": usage.user_id}))
+        await self.db.append_and_increment([usage], rollups, spending)
+
+    async def get_usage(self, req: web.Request):
+        """
+        Returns the session user's spending from the usage rollups, broken down by chat, model and day (UTC).  With
+        'kind' and 'key' query parameters, returns just that one rollup.
+        """
+        session = await self.validate_session(req, user_id=req.query.get('user_id'))
+        if not session:
+            return web.Response(status=401)
+
+        def totals(rollup: DBUsageRollup) -> Dict[str, Any]:
+            return {
+                "requests": rollup.requests,
+                "prompt_tokens": rollup.prompt_tokens,
+                "completion_tokens": rollup.completion_tokens,
+                "cost_usd": rollup.cost_usd
+            }
+
+        if 'kind' in req.query:
+            found = await self.db.find(DBUsageRollup, id="{}/{}/{}".format(session.user_id, req.query['kind'], req.query.get('key', "")))
+            return web.json_response(totals(found[0] if found else DBUsageRollup("", session.user_id, "", "")))
+        data: Dict[str, Any] = {
+            "total": totals(DBUsageRollup("", session.user_id, "total", "")),
+            "chat": {},
+            "model": {},
+            "day": {}
+        }
+        # Rollup ids start with the user id, so this is a range scan of the primary key
+        for rollup in await self.db.select(DBUsageRollup, "id >= ? AND id < ?", [session.user_id + "/", session.user_id + "0"]):
+            if rollup.kind == "total":
+                data["total"] = totals(rollup)
+            elif rollup.kind in data:
+                data[rollup.kind][rollup.key] = totals(rollup)
+        return web.json_response(data)
 
     async def query_user(self, req: web.Request):
         user_id = req.match_info.get("id")
@@ -473,9 +1189,9 @@ class Server():
                 user.api_key = api_key
             await self.db.update(user)
             # invalidate all other sessions
-            for s in filter(lambda s: s.user_id == user.id, list(self.sessions.values())):
+            for s in await self.db.find(DBSession, user_id=user.id):
                 await self.db.delete(s)
-                self.sessions.pop(s.session_id)
+                self.sessions.pop(s.session_id, None)
                 # Create a new session for the user
             session = DBSession(session_id=str(
                 uuid4()), user_id=user.id, created=datetime.now(timezone.utc), last_used=datetime.now(timezone.utc))
@@ -493,9 +1209,13 @@ class Server():
             return web.json_response({})
         if not await self.validate_session(req, user_id=chat.user_id):
             return web.Response(status=401)
-        await self.db.delete(chat)
+        await self.db.write_batch([DBDeletedChat(chat.id, chat.user_id, datetime.now(timezone.utc))], [chat])
         return web.json_response({})
 
+    def clear_tombstones(self, chats: List[DBChat]) -> Tuple[str, List[List[Any]]]:
+        """The statement removing the tombstones of deleted chats that are being saved again, to run in the same transaction"""
+        return ("DELETE FROM deletedchat WHERE id=? AND user_id=?", [[c.id, c.user_id] for c in chats])
+
     async def authStep1(self, req: web.Request):
         """Starts the SRP challenge"""
         started = datetime.now(timezone.utc)
@@ -615,7 +1335,8 @@ class Server():
     async def websocket_stream_handler(self, req: web.Request):
         ws = web.WebSocketResponse()
         await ws.prepare(req)
-        manager = ChatStreamManager(ws)
+        session = await self.validate_session(req)
+        manager = ChatStreamManager(ws, self.completions, self.context, session.user_id if session else "", self.record_usage)
         await manager.start()
         await manager.closed()
         return ws
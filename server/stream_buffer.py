@@ -0,0 +1,121 @@
+import asyncio
+import time
+from typing import Dict, Any, Callable, Awaitable, Union, List
+
+Listener = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class CompletionBuffer():
+    """
+    Keeps the latest frame of a single completion so a client that loses its connection can reattach and pick up where it
+    left off.  Frames are cumulative ('message' holds everything generated so far, 'offset' its length in utf-8 bytes),
+    so only the newest one needs to be kept.  At most one client is attached at a time, and only the user who started
+    the completion can attach to it.
+    """
+
+    def __init__(self, id: str, max_bytes: int, user_id: str, model: str):
+        self.id = id
+        self.max_bytes = max_bytes
+        self.user_id = user_id
+        self.model = model
+        self.frame: Union[Dict[str, Any], None] = None
+        self.truncated = False
+        self.finished = False
+        self.finished_at: Union[float, None] = None
+        self.detached_at: Union[float, None] = time.monotonic()
+        self.task: Union[asyncio.Task, None] = None
+        self._listener: Union[Listener, None] = None
+        self._done = asyncio.Event()
+
+    @property
+    def size(self) -> int:
+        if self.frame is None:
+            return 0
+        return self.frame.get('offset', 0)
+
+    async def publish(self, frame: Dict[str, Any]):
+        if frame.get('offset', 0) > self.max_bytes:
+            # Too big to keep around, so this completion can only be followed live
+            self.truncated = True
+            self.frame = None
+        else:
+            self.frame = frame
+        if self._listener is not None:
+            await self._listener(frame)
+
+    def finish(self):
+        self.finished = True
+        self.finished_at = time.monotonic()
+        self._done.set()
+
+    async def wait_finished(self):
+        await self._done.wait()
+
+    def attach(self, listener: Listener):
+        self._listener = listener
+        self.detached_at = None
+
+    def detach(self, listener: Listener):
+        if self._listener == listener:
+            self._listener = None
+            self.detached_at = time.monotonic()
+
+    def detached_for(self) -> float:
+        if self.detached_at is None:
+            return 0
+        return time.monotonic() - self.detached_at
+
+    def replay(self, offset: int) -> Union[Dict[str, Any], None]:
+        """The newest frame, with 'delta' holding whatever was generated after the client's byte offset"""
+        if self.frame is None:
+            return None
+        frame = dict(self.frame)
+        frame['delta'] = frame['message'].encode()[offset:].decode(errors="ignore")
+        frame['resumed_from'] = offset
+        return frame
+
+
+class CompletionBuffers():
+    """All the completion buffers on the server, keyed by stream id.  Finished buffers are evicted by age or total size."""
+
+    def __init__(self, max_age: float, max_total_bytes: int, max_bytes_per_stream: int):
+        self.max_age = max_age
+        self.max_total_bytes = max_total_bytes
+        self.max_bytes_per_stream = max_bytes_per_stream
+        self._buffers: Dict[str, CompletionBuffer] = {}
+
+    def create(self, id: str, user_id: str, model: str) -> CompletionBuffer:
+        self.evict()
+        buffer = CompletionBuffer(id, self.max_bytes_per_stream, user_id, model)
+        self._buffers[id] = buffer
+        return buffer
+
+    def get(self, id: str) -> Union[CompletionBuffer, None]:
+        self.evict()
+        return self._buffers.get(id)
+
+    def evict(self):
+        now = time.monotonic()
+        finished: List[CompletionBuffer] = []
+        for buffer in list(self._buffers.values()):
+            if not buffer.finished:
+                continue
+            if now - buffer.finished_at > self.max_age:
+                del self._buffers[buffer.id]
+            else:
+                finished.append(buffer)
+        total = sum([b.size for b in self._buffers.values()])
+        for buffer in sorted(finished, key=lambda b: b.finished_at):
+            if total <= self.max_total_bytes:
+                break
+            total -= buffer.size
+            del self._buffers[buffer.id]
+
+    def stats(self) -> Dict[str, Any]:
+        self.evict()
+        return {
+            "streams": len(self._buffers),
+            "running": len([b for b in self._buffers.values() if not b.finished]),
+            "detached": len([b for b in self._buffers.values() if b.detached_at is not None]),
+            "total_bytes": sum([b.size for b in self._buffers.values()])
+        }